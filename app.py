@@ -1,15 +1,29 @@
+import hashlib
 import io
+import json
 import os
+import re
+import threading
+import time
+from collections import OrderedDict
 from datetime import date, datetime
 
 import math
+import numpy as np
+import pandas as pd
 import matplotlib
 matplotlib.use("Agg")
 import matplotlib.pyplot as plt
+from matplotlib import font_manager
+from matplotlib.figure import Figure, SubplotParams
 
-from flask import Flask, Response, redirect, render_template, request, url_for, flash, session
+from PIL import Image
+
+from flask import Flask, make_response, redirect, render_template, request, send_file, url_for, flash, session
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import UniqueConstraint, func
+from sqlalchemy import UniqueConstraint, event, func, text, tuple_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import selectinload
 from functools import wraps
 
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
@@ -21,11 +35,36 @@ app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY", "dev-secret-change-me")
 ADMIN_PASSWORD = os.environ.get("ADMIN_PASSWORD", "admin123")
 
 # Database config
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + os.path.join(BASE_DIR, "utility.db")
+app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get(
+    "DATABASE_URL", "sqlite:///" + os.path.join(BASE_DIR, "utility.db")
+)
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+# Keep connections open across requests so multi-threaded workers don't reconnect per query
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+    "pool_size": 10,
+    "max_overflow": 20,
+    "pool_pre_ping": True,
+    "pool_recycle": 3600,
+    "connect_args": {"check_same_thread": False},
+}
 
 db = SQLAlchemy(app)
 
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets page/chart reads run alongside writes; synchronous/mmap/cache
+    # settings are per-connection, so apply them every time one is opened.
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA mmap_size=268435456")  # 256 MB
+    cursor.execute("PRAGMA cache_size=-64000")    # ~64 MB
+    cursor.close()
+
+
+with app.app_context():
+    event.listen(db.engine, "connect", _set_sqlite_pragmas)
+
 def login_required(view_func):
     @wraps(view_func)
     def wrapper(*args, **kwargs):
@@ -63,8 +102,10 @@ class Customer(db.Model):
     email = db.Column(db.String(180), nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
 
-    usage_records = db.relationship("UsageRecord", backref="customer", cascade="all, delete-orphan")
-    bills = db.relationship("Bill", backref="customer", cascade="all, delete-orphan")
+    usage_records = db.relationship("UsageRecord", back_populates="customer", cascade="all, delete-orphan",
+                                    order_by="(UsageRecord.month, UsageRecord.utility_type)")
+    bills = db.relationship("Bill", back_populates="customer", cascade="all, delete-orphan",
+                            order_by="(Bill.month, Bill.utility_type)")
 
 
 class UsageRecord(db.Model):
@@ -80,8 +121,11 @@ class UsageRecord(db.Model):
 
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
 
+    customer = db.relationship("Customer", back_populates="usage_records")
+
     __table_args__ = (
         UniqueConstraint("customer_id", "month", "utility_type", name="uq_usage_customer_month_type"),
+        db.Index("ix_usage_cust_type_month", "customer_id", "utility_type", "month"),
     )
 
 
@@ -100,9 +144,155 @@ class Bill(db.Model):
 
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
 
+    customer = db.relationship("Customer", back_populates="bills")
+
     __table_args__ = (
         UniqueConstraint("customer_id", "month", "utility_type", name="uq_bill_customer_month_type"),
+        db.Index("ix_bill_cust_type_month", "customer_id", "utility_type", "month"),
+    )
+
+
+def create_missing_indexes() -> None:
+    """Add indexes that db.create_all() skips on tables created by older versions."""
+    for table in (UsageRecord.__table__, Bill.__table__):
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+
+class UsageStats(db.Model):
+    """Running totals per customer/utility so anomaly checks don't rescan history."""
+    __tablename__ = "usage_stats"
+    customer_id = db.Column(db.Integer, db.ForeignKey("customers.id"), primary_key=True)
+    utility_type = db.Column(db.String(32), primary_key=True)
+
+    n = db.Column(db.Integer, nullable=False, default=0)
+    usage_sum = db.Column(db.Float, nullable=False, default=0.0)
+    usage_sumsq = db.Column(db.Float, nullable=False, default=0.0)
+
+    # Robust center/spread used by compute_anomaly_flag
+    usage_median = db.Column(db.Float, nullable=True)
+    usage_mad = db.Column(db.Float, nullable=True)
+
+
+# Per customer/utility median and median absolute deviation (MAD) of usage_value.
+# {where} narrows usage_records (e.g. to one customer/utility); it's always a constant string.
+_MEDIAN_MAD_SQL = """
+    WITH ranked AS (
+        SELECT customer_id, utility_type, usage_value,
+               ROW_NUMBER() OVER (PARTITION BY customer_id, utility_type ORDER BY usage_value) AS rn,
+               COUNT(*) OVER (PARTITION BY customer_id, utility_type) AS cnt
+        FROM usage_records
+        {where}
+    ),
+    medians AS (
+        SELECT customer_id, utility_type, AVG(usage_value) AS med
+        FROM ranked
+        WHERE rn IN ((cnt + 1) / 2, (cnt + 2) / 2)
+        GROUP BY customer_id, utility_type
+    ),
+    deviations AS (
+        SELECT r.customer_id, r.utility_type, r.cnt, ABS(r.usage_value - m.med) AS dev,
+               ROW_NUMBER() OVER (PARTITION BY r.customer_id, r.utility_type
+                                  ORDER BY ABS(r.usage_value - m.med)) AS rn
+        FROM ranked r JOIN medians m USING (customer_id, utility_type)
+    )
+    SELECT d.customer_id, d.utility_type, m.med AS usage_median, AVG(d.dev) AS usage_mad
+    FROM deviations d JOIN medians m USING (customer_id, utility_type)
+    WHERE d.rn IN ((d.cnt + 1) / 2, (d.cnt + 2) / 2)
+    GROUP BY d.customer_id, d.utility_type
+"""
+
+
+def _refresh_median_mad(where: str = "", params: dict = None) -> None:
+    rows = db.session.execute(text(_MEDIAN_MAD_SQL.format(where=where)), params or {}).mappings().all()
+    if rows:
+        # Bulk UPDATE by primary key (customer_id, utility_type)
+        db.session.execute(db.update(UsageStats), [dict(r) for r in rows])
+
+
+def record_usage_stats(customer_id: int, utility_type: str, usage_value: float) -> None:
+    """Fold one new usage value into usage_stats (caller commits)."""
+    stmt = sqlite_insert(UsageStats).values(
+        customer_id=customer_id,
+        utility_type=utility_type,
+        n=1,
+        usage_sum=usage_value,
+        usage_sumsq=usage_value * usage_value,
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[UsageStats.customer_id, UsageStats.utility_type],
+        set_={
+            "n": UsageStats.n + 1,
+            "usage_sum": UsageStats.usage_sum + usage_value,
+            "usage_sumsq": UsageStats.usage_sumsq + usage_value * usage_value,
+        },
+    )
+    db.session.execute(stmt)
+
+    # Median/MAD can't be updated incrementally, so this re-reads and sorts (twice) every
+    # record for this customer/utility on each insert. The ix_usage_cust_type_month range
+    # keeps it to one customer's history, but it is O(k log k) per POST, not O(1) like the sums.
+    db.session.flush()
+    _refresh_median_mad(
+        "WHERE customer_id = :customer_id AND utility_type = :utility_type",
+        {"customer_id": customer_id, "utility_type": utility_type},
+    )
+
+
+def rebuild_usage_stats() -> None:
+    """
+    Recompute usage_stats from usage_records.
+
+    The table only holds derived data, so it is dropped and recreated to pick up
+    any column changes in databases created by older versions.
+    """
+    UsageStats.__table__.drop(db.engine, checkfirst=True)
+    UsageStats.__table__.create(db.engine)
+    db.session.execute(
+        sqlite_insert(UsageStats).from_select(
+            ["customer_id", "utility_type", "n", "usage_sum", "usage_sumsq"],
+            db.select(UsageRecord.customer_id,
+                      UsageRecord.utility_type,
+                      func.count(UsageRecord.id),
+                      func.sum(UsageRecord.usage_value),
+                      func.sum(UsageRecord.usage_value * UsageRecord.usage_value))
+            .group_by(UsageRecord.customer_id, UsageRecord.utility_type),
+        )
+    )
+    _refresh_median_mad()
+    db.session.commit()
+
+
+class MonthlyTotal(db.Model):
+    """Usage summed across all customers per month/utility, kept current on insert."""
+    __tablename__ = "monthly_totals"
+    month = db.Column(db.String(7), primary_key=True)
+    utility_type = db.Column(db.String(32), primary_key=True)
+
+    total = db.Column(db.Float, nullable=False, default=0.0)
+
+
+def record_monthly_total(month: str, utility_type: str, usage_value: float) -> None:
+    """Add one new usage value to monthly_totals (caller commits)."""
+    stmt = sqlite_insert(MonthlyTotal).values(month=month, utility_type=utility_type, total=usage_value)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[MonthlyTotal.month, MonthlyTotal.utility_type],
+        set_={"total": MonthlyTotal.total + usage_value},
+    )
+    db.session.execute(stmt)
+
+
+def rebuild_monthly_totals() -> None:
+    """Recompute monthly_totals from usage_records."""
+    db.session.query(MonthlyTotal).delete()
+    db.session.execute(
+        sqlite_insert(MonthlyTotal).from_select(
+            ["month", "utility_type", "total"],
+            db.select(UsageRecord.month, UsageRecord.utility_type, func.sum(UsageRecord.usage_value))
+            .group_by(UsageRecord.month, UsageRecord.utility_type),
+        )
     )
+    db.session.commit()
 
 
 # ----------------------------
@@ -112,52 +302,320 @@ def calculate_bill(usage_value: float, rate_per_unit: float, base_fee: float) ->
     return round(base_fee + (usage_value * rate_per_unit), 2)
 
 
+# utility_type -> (rate_per_unit, base_fee)
 DEFAULT_RATES = {
-    "electric": {"rate_per_unit": 0.16, "base_fee": 8.00},  # $/kWh, base fee
-    "water": {"rate_per_unit": 0.005, "base_fee": 10.00},   # $/gallon (example)
-    "gas": {"rate_per_unit": 1.20, "base_fee": 12.00},      # $/therm (example)
+    "electric": (0.16, 8.00),   # $/kWh, base fee
+    "water": (0.005, 10.00),    # $/gallon (example)
+    "gas": (1.20, 12.00),       # $/therm (example)
 }
 
+def generate_bills_for_month(month: str) -> int:
+    """
+    Creates bills for every usage record in a month that isn't billed yet.
+
+    Reads the unbilled records in one query and writes all bills with a single
+    executemany INSERT instead of a query + insert per record. Totals go through
+    calculate_bill so they round exactly like generate_bill. Returns the number
+    of bills created.
+    """
+    unbilled = db.session.execute(
+        db.select(UsageRecord.customer_id, UsageRecord.utility_type, UsageRecord.usage_value)
+        .outerjoin(Bill, (Bill.customer_id == UsageRecord.customer_id)
+                   & (Bill.month == UsageRecord.month)
+                   & (Bill.utility_type == UsageRecord.utility_type))
+        .where(UsageRecord.month == month,
+               UsageRecord.utility_type.in_(list(DEFAULT_RATES)),
+               Bill.id.is_(None))
+    ).all()
+    if not unbilled:
+        return 0
+
+    now = datetime.utcnow()
+    bills = []
+    for customer_id, utility_type, usage_value in unbilled:
+        rate_per_unit, base_fee = DEFAULT_RATES[utility_type]
+        bills.append({
+            "customer_id": customer_id,
+            "month": month,
+            "utility_type": utility_type,
+            "usage_value": usage_value,
+            "rate_per_unit": rate_per_unit,
+            "base_fee": base_fee,
+            "total_amount": calculate_bill(usage_value, rate_per_unit, base_fee),
+            "created_at": now,
+        })
+
+    # A bill created concurrently since the SELECT is skipped by the unique constraint
+    result = db.session.execute(sqlite_insert(Bill.__table__).on_conflict_do_nothing(), bills)
+    db.session.commit()
+    return result.rowcount
+
+
+# YYYY-MM with a real month number
+_MONTH_RE = re.compile(r"[0-9]{4}-(0[1-9]|1[0-2])")
+
 UTILITY_UNITS = {
     "electric": "kWh",
     "water": "gallons",
     "gas": "CCF",
 }
 
+# Scales MAD to a standard-deviation equivalent for normally distributed usage
+MAD_SCALE = 1.4826
+# Smallest spread allowed when MAD is 0, as a fraction of the median
+MIN_SPREAD_FRACTION = 0.05
+
+
 def compute_anomaly_flag(customer_id: int, utility_type: str, new_value: float) -> bool:
     """
-    Flags anomalies using a simple rule:
-    new_value > mean + 2 * std, computed from that customer's past records
-    for the same utility type.
+    Flags anomalies using a robust rule:
+    |new_value - median| > 3 * 1.4826 * MAD, computed from that customer's past
+    records for the same utility type. Unlike mean/std, a single huge reading
+    doesn't inflate the spread enough to hide the next one.
+
+    MAD is 0 when more than half the readings are identical; then the spread
+    falls back to the std from the running sums, but never below 5% of the median.
 
     Needs at least 5 prior records to avoid noisy flags.
     """
-    history = (UsageRecord.query
-               .filter_by(customer_id=customer_id, utility_type=utility_type)
-               .order_by(UsageRecord.month.asc())
-               .all())
+    stats = db.session.get(UsageStats, (customer_id, utility_type))
+    n = stats.n if stats else 0
+
+    if n < 5:
+        return False
 
-    if len(history) < 5:
+    median = stats.usage_median
+    if median is None:
         return False
 
-    vals = [r.usage_value for r in history]
-    mean = sum(vals) / len(vals)
+    # NULL MAD (e.g. SQLite storing a NaN) is treated like 0 rather than crashing the POST
+    mad = stats.usage_mad or 0.0
+    if mad > 0:
+        spread = MAD_SCALE * mad
+    else:
+        mean = stats.usage_sum / n
+        # Population variance from the running sums; clamp tiny negative rounding error
+        std = math.sqrt(max(stats.usage_sumsq / n - mean * mean, 0.0))
+        spread = max(std, MIN_SPREAD_FRACTION * abs(median))
+
+    return abs(new_value - median) > 3 * spread
+
+def compute_anomaly_flags_batch(rows: pd.DataFrame) -> np.ndarray:
+    """
+    Vectorized compute_anomaly_flag for a batch of new usage values.
+
+    rows needs customer_id, utility_type and usage_value columns. Every row is
+    judged against usage_stats as it stood before the batch, using the same
+    median/MAD rule (and 5-record minimum) as the single-record check.
+    Returns a boolean array aligned with rows.
+    """
+    if rows.empty:
+        return np.zeros(0, dtype=bool)
+
+    keys = list(rows[["customer_id", "utility_type"]]
+                .drop_duplicates()
+                .itertuples(index=False, name=None))
+
+    stats_rows = []
+    for i in range(0, len(keys), 500):  # stay well under SQLite's bound-parameter limit
+        stats_rows += db.session.execute(
+            db.select(UsageStats.customer_id, UsageStats.utility_type,
+                      UsageStats.n, UsageStats.usage_sum, UsageStats.usage_sumsq,
+                      UsageStats.usage_median, UsageStats.usage_mad)
+            .where(tuple_(UsageStats.customer_id, UsageStats.utility_type).in_(keys[i:i + 500]))
+        ).all()
+
+    stats = pd.DataFrame(stats_rows, columns=["customer_id", "utility_type", "n", "usage_sum", "usage_sumsq",
+                                              "usage_median", "usage_mad"])
+    merged = (rows[["customer_id", "utility_type"]]
+              .astype({"customer_id": "int64", "utility_type": "object"})
+              .merge(stats.astype({"customer_id": "int64", "utility_type": "object"}),
+                     how="left", on=["customer_id", "utility_type"]))
+
+    n = merged["n"].to_numpy(dtype=np.float64, na_value=0.0)
+    median = merged["usage_median"].to_numpy(dtype=np.float64)
+    mad = merged["usage_mad"].to_numpy(dtype=np.float64)
+    v = rows["usage_value"].to_numpy(dtype=np.float64)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = merged["usage_sum"].to_numpy(dtype=np.float64) / n
+        var = np.maximum(merged["usage_sumsq"].to_numpy(dtype=np.float64) / n - mean * mean, 0.0)
+    std = np.sqrt(var)
+
+    # Same rule as compute_anomaly_flag; rows without enough history are masked by n >= 5
+    spread = np.where(mad > 0, MAD_SCALE * mad, np.maximum(std, MIN_SPREAD_FRACTION * np.abs(median)))
+    return (n >= 5) & (np.abs(v - median) > 3 * spread)
+
+def add_usage_batch(rows: pd.DataFrame) -> np.ndarray:
+    """
+    Inserts many validated usage rows and updates the derived tables (caller commits).
+
+    rows needs customer_id, month, utility_type and usage_value columns.
+    Anomaly flags come from compute_anomaly_flags_batch; returns them.
+    """
+    flags = compute_anomaly_flags_batch(rows)
+    records = rows[["customer_id", "month", "utility_type", "usage_value"]].assign(is_anomaly=flags)
+
+    # executemany path: one prepared INSERT for the whole batch
+    db.session.execute(db.insert(UsageRecord), records.to_dict("records"))
+
+    stats = (rows.assign(usage_sq=rows["usage_value"] ** 2)
+             .groupby(["customer_id", "utility_type"], as_index=False)
+             .agg(n=("usage_value", "size"),
+                  usage_sum=("usage_value", "sum"),
+                  usage_sumsq=("usage_sq", "sum")))
+    stmt = sqlite_insert(UsageStats)
+    db.session.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[UsageStats.customer_id, UsageStats.utility_type],
+            set_={
+                "n": UsageStats.n + stmt.excluded.n,
+                "usage_sum": UsageStats.usage_sum + stmt.excluded.usage_sum,
+                "usage_sumsq": UsageStats.usage_sumsq + stmt.excluded.usage_sumsq,
+            },
+        ),
+        stats.to_dict("records"),
+    )
+    _refresh_median_mad(
+        "WHERE customer_id IN (SELECT value FROM json_each(:customer_ids))",
+        {"customer_ids": json.dumps(stats["customer_id"].unique().tolist())},
+    )
+
+    totals = rows.groupby(["month", "utility_type"], as_index=False).agg(total=("usage_value", "sum"))
+    stmt = sqlite_insert(MonthlyTotal)
+    db.session.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[MonthlyTotal.month, MonthlyTotal.utility_type],
+            set_={"total": MonthlyTotal.total + stmt.excluded.total},
+        ),
+        totals.to_dict("records"),
+    )
+    return flags
+
+# ----------------------------
+# Chart rendering
+# ----------------------------
+CHART_CACHE_SIZE = 128
+_chart_cache = OrderedDict()  # cache_key -> PNG bytes, least recently used first
+_chart_cache_lock = threading.Lock()
+
+
+_chart_tls = threading.local()
+
+
+def _warm_matplotlib() -> None:
+    """Load the font cache and draw one tiny figure so the first chart request doesn't pay for it."""
+    font_manager.findfont(font_manager.FontProperties())
+    warm = Figure(figsize=(1, 1), dpi=10)
+    warm.text(0.5, 0.5, "0")
+    # A bare Figure's canvas is FigureCanvasBase, whose draw() is a no-op; savefig goes through Agg
+    warm.savefig(io.BytesIO(), format="png")
+
+
+# Runs at import, so under `gunicorn --preload` it happens once before workers fork
+_warm_matplotlib()
+
+
+def _thread_figure(figsize=None) -> Figure:
+    """
+    Returns this thread's reusable chart Figure, cleared and resized to figsize.
+
+    Built with matplotlib.figure.Figure rather than pyplot so it isn't tracked
+    by pyplot's global figure manager, which is not thread-safe. Only the Figure
+    and its canvas are reused; callers add fresh axes so no tick/grid settings
+    carry over from the previous chart.
+    """
+    fig = getattr(_chart_tls, "fig", None)
+    if fig is None:
+        fig = Figure()
+        _chart_tls.fig = fig
+    fig.clear()
+    fig.subplotpars = SubplotParams()  # tight_layout() leaves the previous chart's margins behind
+    fig.set_size_inches(figsize or plt.rcParams["figure.figsize"])
+    return fig
+
+
+def _render_png(cache_key, draw_fn, figsize=None) -> bytes:
+    """
+    Returns PNG bytes for a chart, rendering with matplotlib only on a cache miss.
+
+    cache_key should change whenever the underlying data does (e.g. include the
+    latest created_at), so stale entries simply age out of the LRU.
+    """
+    with _chart_cache_lock:
+        png = _chart_cache.get(cache_key)
+        if png is not None:
+            _chart_cache.move_to_end(cache_key)
+            return png
+
+    fig = _thread_figure(figsize)
+    ax = fig.add_subplot()
+    draw_fn(ax)
+    fig.tight_layout()
 
-    var = sum((x - mean) ** 2 for x in vals) / len(vals)
-    std = math.sqrt(var)
+    raw = io.BytesIO()
+    fig.savefig(raw, format="png", dpi=150)
+    raw.seek(0)
+
+    # Line charts use only a handful of colors; an adaptive palette PNG is far smaller than RGBA
+    buf = io.BytesIO()
+    img = Image.open(raw).convert("RGB").convert("P", palette=Image.Palette.ADAPTIVE, colors=64)
+    img.save(buf, format="png", optimize=True)
+    png = buf.getvalue()
+
+    with _chart_cache_lock:
+        _chart_cache[cache_key] = png
+        _chart_cache.move_to_end(cache_key)
+        while len(_chart_cache) > CHART_CACHE_SIZE:
+            _chart_cache.popitem(last=False)
+    return png
+
+
+def _chart_response(cache_key, draw_fn, figsize=None):
+    """
+    Serves a chart PNG with an ETag derived from cache_key.
+
+    A browser that already holds the same data signature gets a bodyless 304
+    without touching the PNG cache or matplotlib. Responses are marked no-cache
+    so the browser revalidates every time; otherwise a chart would stay stale
+    right after add_usage redirects back to the page that embeds it.
+    """
+    etag = hashlib.md5(repr(cache_key).encode()).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = make_response("", 304)
+    else:
+        png = _render_png(cache_key, draw_fn, figsize=figsize)
+        response = send_file(io.BytesIO(png), mimetype="image/png")
 
-    # If std is 0, only flag if it's strictly higher than mean
-    threshold = mean + (2 * std)
-    return new_value > threshold if std > 0 else new_value > mean
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
 
 # ----------------------------
 # Routes
 # ----------------------------
+HOME_COUNTS_TTL = 5.0  # seconds; the landing page doesn't need exact counts
+_home_counts_cache = (0.0, None)  # (expires_at, counts)
+
+
+def home_counts() -> tuple:
+    """Returns (customers, usage records, bills) counts in one round-trip, cached briefly."""
+    global _home_counts_cache
+    expires_at, counts = _home_counts_cache
+    now = time.monotonic()
+    if counts is None or now >= expires_at:
+        counts = tuple(db.session.execute(text(
+            "SELECT (SELECT COUNT(*) FROM customers),"
+            " (SELECT COUNT(*) FROM usage_records),"
+            " (SELECT COUNT(*) FROM bills)"
+        )).one())
+        _home_counts_cache = (now + HOME_COUNTS_TTL, counts)
+    return counts
+
+
 @app.get("/")
 def home():
-    customer_count = Customer.query.count()
-    usage_count = UsageRecord.query.count()
-    bill_count = Bill.query.count()
+    customer_count, usage_count, bill_count = home_counts()
     return render_template("home.html",
                            customer_count=customer_count,
                            usage_count=usage_count,
@@ -165,38 +623,37 @@ def home():
 
 @app.get("/charts/total_electric_usage.png")
 def total_electric_usage_chart():
-    # Sum electric usage across ALL customers, grouped by month
-    rows = (
-        db.session.query(UsageRecord.month, func.sum(UsageRecord.usage_value))
-        .filter(UsageRecord.utility_type == "electric")
-        .group_by(UsageRecord.month)
-        .order_by(UsageRecord.month.asc())
-        .all()
+    # Month count + grand total only change when the plotted series does
+    cache_key = ("total_electric_usage",) + tuple(
+        db.session.query(func.count(), func.sum(MonthlyTotal.total))
+        .filter(MonthlyTotal.utility_type == "electric")
+        .one()
     )
 
-    months = [r[0] for r in rows]
-    totals = [float(r[1]) for r in rows]
-
-    fig, ax = plt.subplots(figsize=(10, 3.2))
-    ax.set_title("Total Electric Usage Over Time (All Customers)")
-    ax.set_xlabel("Month")
-    ax.set_ylabel("Total Usage (kWh)")
-
-    if months:
-        ax.plot(months, totals, marker="o", linewidth=2)
-        ax.tick_params(axis="x", rotation=45)
-        ax.grid(True, alpha=0.25)
-    else:
-        ax.text(0.5, 0.5, "No electric usage records yet", ha="center", va="center", transform=ax.transAxes)
-
-    fig.tight_layout()
-
-    buf = io.BytesIO()
-    fig.savefig(buf, format="png", dpi=150)
-    plt.close(fig)
-    buf.seek(0)
+    def draw(ax):
+        # Electric usage across ALL customers, pre-summed by month
+        rows = (
+            db.session.query(MonthlyTotal.month, MonthlyTotal.total)
+            .filter(MonthlyTotal.utility_type == "electric")
+            .order_by(MonthlyTotal.month.asc())
+            .all()
+        )
+
+        months, totals = zip(*rows) if rows else ((), ())
+        totals = np.fromiter(totals, dtype=np.float64, count=len(rows))
+
+        ax.set_title("Total Electric Usage Over Time (All Customers)")
+        ax.set_xlabel("Month")
+        ax.set_ylabel("Total Usage (kWh)")
+
+        if months:
+            ax.plot(months, totals, marker="o", linewidth=2)
+            ax.tick_params(axis="x", rotation=45)
+            ax.grid(True, alpha=0.25)
+        else:
+            ax.text(0.5, 0.5, "No electric usage records yet", ha="center", va="center", transform=ax.transAxes)
 
-    return Response(buf.getvalue(), mimetype="image/png")
+    return _chart_response(cache_key, draw, figsize=(10, 3.2))
 
 @app.route("/customers", methods=["GET", "POST"])
 def customers():
@@ -219,20 +676,14 @@ def customers():
 
 @app.get("/customers/<int:customer_id>")
 def customer_detail(customer_id: int):
-    customer = Customer.query.get_or_404(customer_id)
-    usage = (UsageRecord.query
-             .filter_by(customer_id=customer_id)
-             .order_by(UsageRecord.month.asc(), UsageRecord.utility_type.asc())
-             .all())
-    bills = (Bill.query
-             .filter_by(customer_id=customer_id)
-             .order_by(Bill.month.asc(), Bill.utility_type.asc())
-             .all())
+    customer = (Customer.query
+                .options(selectinload(Customer.usage_records), selectinload(Customer.bills))
+                .get_or_404(customer_id))
     return render_template(
     "customer_detail.html",
     customer=customer,
-    usage=usage,
-    bills=bills,
+    usage=customer.usage_records,
+    bills=customer.bills,
     units=UTILITY_UNITS
 )
 
@@ -245,13 +696,13 @@ def add_usage(customer_id: int):
     utility_type = request.form.get("utility_type", "electric").strip()
     usage_value_raw = request.form.get("usage_value", "").strip()
 
-    if len(month) != 7 or month[4] != "-":
+    if not _MONTH_RE.fullmatch(month):
         flash("Month must be in YYYY-MM format (example: 2026-01).", "danger")
         return redirect(url_for("customer_detail", customer_id=customer_id))
 
     try:
         usage_value = float(usage_value_raw)
-        if usage_value < 0:
+        if not math.isfinite(usage_value) or usage_value < 0:
             raise ValueError()
     except ValueError:
         flash("Usage value must be a non-negative number.", "danger")
@@ -274,6 +725,8 @@ def add_usage(customer_id: int):
 
     try:
         db.session.add(record)
+        record_usage_stats(customer_id, utility_type, usage_value)
+        record_monthly_total(month, utility_type, usage_value)
         db.session.commit()
 
         if is_anomaly:
@@ -288,6 +741,71 @@ def add_usage(customer_id: int):
     return redirect(url_for("customer_detail", customer_id=customer_id))
 
 
+@app.route("/usage/bulk", methods=["POST"])
+@login_required
+def add_usage_bulk():
+    # CSV with a header row: customer_id,month,utility_type,usage_value
+    upload = request.files.get("file")
+    if not upload or not upload.filename:
+        flash("Choose a CSV file to import.", "danger")
+        return redirect(url_for("customers"))
+
+    try:
+        rows = pd.read_csv(upload, dtype=str, keep_default_na=False)
+    except pd.errors.EmptyDataError:
+        flash("That CSV file is empty.", "danger")
+        return redirect(url_for("customers"))
+    except (ValueError, pd.errors.ParserError):
+        flash("Could not read that CSV file.", "danger")
+        return redirect(url_for("customers"))
+
+    required = ["customer_id", "month", "utility_type", "usage_value"]
+    if not set(required) <= set(rows.columns):
+        flash("CSV must have a header row with " + ", ".join(required) + ".", "danger")
+        return redirect(url_for("customers"))
+    if rows.empty:
+        flash("That CSV file has a header but no usage rows.", "danger")
+        return redirect(url_for("customers"))
+
+    rows = rows[required].apply(lambda col: col.str.strip())
+    rows["usage_value"] = pd.to_numeric(rows["usage_value"], errors="coerce")
+
+    invalid = (
+        ~rows["month"].map(lambda m: bool(_MONTH_RE.fullmatch(m)))
+        | ~rows["utility_type"].isin(list(DEFAULT_RATES))
+        # Whole ids only ("1.5" must not become 1), short enough to fit in int64
+        | ~rows["customer_id"].str.fullmatch(r"[0-9]{1,18}")
+        | ~(np.isfinite(rows["usage_value"]) & (rows["usage_value"] >= 0))
+    )
+    if invalid.any():
+        # Data-row number, not file line: read_csv skips blank lines and quoted fields can span lines
+        row = int(invalid.to_numpy().argmax()) + 1
+        flash(f"Data row {row} (not counting the header): needs a whole-number customer id, "
+              "YYYY-MM month, valid utility type and finite, non-negative usage value. "
+              "Nothing was imported.", "danger")
+        return redirect(url_for("customers"))
+
+    rows["customer_id"] = rows["customer_id"].astype("int64")
+    customer_ids = rows["customer_id"].unique().tolist()
+    known = {cid for (cid,) in db.session.query(Customer.id).filter(Customer.id.in_(customer_ids))}
+    unknown = sorted(set(customer_ids) - known)
+    if unknown:
+        flash(f"Unknown customer id(s): {', '.join(map(str, unknown))}. Nothing was imported.", "danger")
+        return redirect(url_for("customers"))
+
+    # One transaction (and one commit/fsync) for the whole file
+    try:
+        flags = add_usage_batch(rows)
+        db.session.commit()
+        flash(f"Imported {len(rows)} usage record(s); {int(flags.sum())} flagged as anomalies.", "success")
+    except Exception:
+        db.session.rollback()
+        flash("Some of those usage records already exist (or another DB error occurred). "
+              "Nothing was imported.", "danger")
+
+    return redirect(url_for("customers"))
+
+
 @app.route("/customers/<int:customer_id>/generate_bill", methods=["POST"])
 def generate_bill(customer_id: int):
     Customer.query.get_or_404(customer_id)
@@ -295,21 +813,24 @@ def generate_bill(customer_id: int):
     month = request.form.get("month", "").strip()
     utility_type = request.form.get("utility_type", "electric").strip()
 
-    record = UsageRecord.query.filter_by(customer_id=customer_id, month=month, utility_type=utility_type).first()
-    if not record:
+    usage_value = db.session.execute(
+        db.select(UsageRecord.usage_value)
+        .filter_by(customer_id=customer_id, month=month, utility_type=utility_type)
+    ).scalar()
+    if usage_value is None:
         flash("No usage record found for that month/type.", "danger")
         return redirect(url_for("customer_detail", customer_id=customer_id))
 
-    rate_info = DEFAULT_RATES[utility_type]
-    total = calculate_bill(record.usage_value, rate_info["rate_per_unit"], rate_info["base_fee"])
+    rate_per_unit, base_fee = DEFAULT_RATES[utility_type]
+    total = calculate_bill(usage_value, rate_per_unit, base_fee)
 
     bill = Bill(
         customer_id=customer_id,
         month=month,
         utility_type=utility_type,
-        usage_value=record.usage_value,
-        rate_per_unit=rate_info["rate_per_unit"],
-        base_fee=rate_info["base_fee"],
+        usage_value=usage_value,
+        rate_per_unit=rate_per_unit,
+        base_fee=base_fee,
         total_amount=total,
     )
 
@@ -324,37 +845,51 @@ def generate_bill(customer_id: int):
     return redirect(url_for("customer_detail", customer_id=customer_id))
 
 
+@app.route("/bills/generate", methods=["POST"])
+@login_required
+def generate_bills():
+    month = request.form.get("month", "").strip()
+
+    if not _MONTH_RE.fullmatch(month):
+        flash("Month must be in YYYY-MM format (example: 2026-01).", "danger")
+        return redirect(url_for("customers"))
+
+    created = generate_bills_for_month(month)
+    flash(f"Generated {created} bill(s) for {month}.", "success")
+    return redirect(url_for("customers"))
+
+
 @app.get("/customers/<int:customer_id>/usage_chart.png")
 def usage_chart(customer_id: int):
     customer = Customer.query.get_or_404(customer_id)
 
     # For demo: chart electric usage over time
-    records = (UsageRecord.query
-               .filter_by(customer_id=customer_id, utility_type="electric")
-               .order_by(UsageRecord.month.asc())
-               .all())
-
-    months = [r.month for r in records]
-    values = [r.usage_value for r in records]
-
-    fig, ax = plt.subplots()
-    ax.set_title(f"Electric Usage Over Time — {customer.full_name}")
-    ax.set_xlabel("Month")
-    ax.set_ylabel("Usage (kWh)")
-    if months:
-        ax.plot(months, values, marker="o")
-        ax.tick_params(axis="x", rotation=45)
-    else:
-        ax.text(0.5, 0.5, "No electric usage records yet", ha="center", va="center", transform=ax.transAxes)
-
-    fig.tight_layout()
+    cache_key = ("usage_chart", customer_id) + tuple(
+        db.session.query(func.max(UsageRecord.created_at), func.count(UsageRecord.id))
+        .filter_by(customer_id=customer_id, utility_type="electric")
+        .one()
+    )
 
-    buf = io.BytesIO()
-    fig.savefig(buf, format="png", dpi=150)
-    plt.close(fig)
-    buf.seek(0)
+    def draw(ax):
+        rows = db.session.execute(
+            db.select(UsageRecord.month, UsageRecord.usage_value)
+            .filter_by(customer_id=customer_id, utility_type="electric")
+            .order_by(UsageRecord.month.asc())
+        ).all()
+
+        months = [r.month for r in rows]
+        values = [r.usage_value for r in rows]
+
+        ax.set_title(f"Electric Usage Over Time — {customer.full_name}")
+        ax.set_xlabel("Month")
+        ax.set_ylabel("Usage (kWh)")
+        if months:
+            ax.plot(months, values, marker="o")
+            ax.tick_params(axis="x", rotation=45)
+        else:
+            ax.text(0.5, 0.5, "No electric usage records yet", ha="center", va="center", transform=ax.transAxes)
 
-    return Response(buf.getvalue(), mimetype="image/png")
+    return _chart_response(cache_key, draw)
 
 
 # ----------------------------
@@ -364,10 +899,16 @@ def usage_chart(customer_id: int):
 def init_db():
     """Initialize the database tables."""
     db.create_all()
+    create_missing_indexes()
+    rebuild_usage_stats()
+    rebuild_monthly_totals()
     print("Database initialized.")
 
 
 if __name__ == "__main__":
     with app.app_context():
         db.create_all()
+        create_missing_indexes()
+        rebuild_usage_stats()
+        rebuild_monthly_totals()
     app.run(debug=True)
\ No newline at end of file
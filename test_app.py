@@ -0,0 +1,196 @@
+import io
+import os
+import statistics
+import tempfile
+
+# Point the app at a throwaway database before it creates its engine
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "test.db")
+
+import pandas as pd
+import pytest
+from sqlalchemy import event
+from sqlalchemy.orm import Session, raiseload
+
+import app as billing
+from app import Bill, Customer, UsageRecord, UsageStats, app, db
+
+
+@pytest.fixture
+def client():
+    app.config["TESTING"] = True
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+    billing._chart_cache.clear()
+    billing._home_counts_cache = (0.0, None)
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess["is_admin"] = True
+    return client
+
+
+def add_customer(client, name="Jane Doe") -> int:
+    client.post("/customers", data={"full_name": name})
+    with app.app_context():
+        return Customer.query.filter_by(full_name=name).one().id
+
+
+def add_usage(client, customer_id, values, utility_type="electric", year=2025):
+    for i, value in enumerate(values, 1):
+        client.post(f"/customers/{customer_id}/usage",
+                    data={"month": f"{year}-{i:02d}", "utility_type": utility_type, "usage_value": value})
+
+
+def upload_csv(client, body: str):
+    return client.post("/usage/bulk",
+                       data={"file": (io.BytesIO(body.encode()), "usage.csv")},
+                       content_type="multipart/form-data",
+                       follow_redirects=True)
+
+
+CSV_HEADER = "customer_id,month,utility_type,usage_value\n"
+
+
+def test_customer_detail_renders_without_lazy_loads(client):
+    customer_id = add_customer(client)
+    add_usage(client, customer_id, [100, 110])
+    client.post(f"/customers/{customer_id}/generate_bill", data={"month": "2025-01", "utility_type": "electric"})
+
+    # Every top-level ORM query raises on lazy loads, so any N+1 access in the template fails the render
+    def add_raiseload(state):
+        if state.is_select and not state.is_relationship_load:
+            state.statement = state.statement.options(raiseload("*"))
+
+    event.listen(Session, "do_orm_execute", add_raiseload)
+    try:
+        response = client.get(f"/customers/{customer_id}")
+    finally:
+        event.remove(Session, "do_orm_execute", add_raiseload)
+
+    assert response.status_code == 200
+    assert b"2025-02" in response.data
+    assert b"$24.00" in response.data
+
+
+@pytest.mark.parametrize("values", [
+    [5, 1, 9, 3],           # even count: median averages the middle pair
+    [5, 1, 9, 3, 7],        # odd count
+    [100, 100, 100, 120],   # MAD of 0
+])
+def test_median_mad_matches_statistics(client, values):
+    customer_id = add_customer(client)
+    add_usage(client, customer_id, values)
+
+    median = statistics.median(values)
+    mad = statistics.median(abs(v - median) for v in values)
+    with app.app_context():
+        stats = db.session.get(UsageStats, (customer_id, "electric"))
+        assert stats.n == len(values)
+        assert stats.usage_median == pytest.approx(median)
+        assert stats.usage_mad == pytest.approx(mad)
+
+        # The full rebuild must agree with the per-insert refresh
+        billing.rebuild_usage_stats()
+        stats = db.session.get(UsageStats, (customer_id, "electric"))
+        assert (stats.usage_median, stats.usage_mad) == pytest.approx((median, mad))
+
+
+def test_anomaly_flag_ignores_small_change_when_mad_is_zero(client):
+    customer_id = add_customer(client)
+    add_usage(client, customer_id, [100, 100, 100, 120, 150])
+
+    with app.app_context():
+        assert not billing.compute_anomaly_flag(customer_id, "electric", 101)
+        assert billing.compute_anomaly_flag(customer_id, "electric", 200)
+
+
+def test_batch_flags_match_single_record_flags(client):
+    spread = add_customer(client, "Spread")
+    flat = add_customer(client, "Flat")
+    short = add_customer(client, "Short")
+    add_usage(client, spread, [10, 12, 11, 13, 50])
+    add_usage(client, flat, [100, 100, 100, 120, 150], utility_type="water")
+    add_usage(client, short, [1, 2, 3])
+
+    rows = pd.DataFrame(
+        [(spread, "electric", v) for v in (0, 11, 14, 20, 60)]
+        + [(flat, "water", v) for v in (99, 101, 140, 200)]
+        + [(short, "electric", 1000), (spread, "gas", 5)],
+        columns=["customer_id", "utility_type", "usage_value"],
+    )
+    with app.app_context():
+        batch = billing.compute_anomaly_flags_batch(rows)
+        single = [billing.compute_anomaly_flag(r.customer_id, r.utility_type, r.usage_value)
+                  for r in rows.itertuples()]
+    assert batch.tolist() == single
+    assert any(single) and not all(single)
+
+
+def test_bulk_import_inserts_rows_and_updates_stats(client):
+    customer_id = add_customer(client)
+    response = upload_csv(client, CSV_HEADER
+                          + f"{customer_id},2025-01,electric,100\n"
+                          + f"{customer_id},2025-02,electric,120\n"
+                          + f"{customer_id},2025-01,gas,3\n")
+
+    assert b"Imported 3 usage record(s)" in response.data
+    with app.app_context():
+        assert UsageRecord.query.count() == 3
+        stats = db.session.get(UsageStats, (customer_id, "electric"))
+        assert (stats.n, stats.usage_sum, stats.usage_median) == (2, 220.0, 110.0)
+        total = db.session.get(billing.MonthlyTotal, ("2025-01", "electric"))
+        assert total.total == 100.0
+
+
+@pytest.mark.parametrize("bad_row", [
+    "{cid},2025-13,electric,100",
+    "{cid},2025-02,steam,100",
+    "{cid},2025-02,electric,-1",
+    "{cid},2025-02,electric,inf",
+    "1.5,2025-02,electric,100",
+    "99999999999999999999,2025-02,electric,100",
+])
+def test_bulk_import_rejects_invalid_rows(client, bad_row):
+    customer_id = add_customer(client)
+    response = upload_csv(client, CSV_HEADER
+                          + f"{customer_id},2025-01,electric,100\n"
+                          + bad_row.format(cid=customer_id) + "\n")
+
+    assert b"Data row 2" in response.data
+    with app.app_context():
+        assert UsageRecord.query.count() == 0
+
+
+def test_bulk_import_rolls_back_on_duplicate(client):
+    customer_id = add_customer(client)
+    add_usage(client, customer_id, [100])
+
+    response = upload_csv(client, CSV_HEADER
+                          + f"{customer_id},2025-02,electric,120\n"
+                          + f"{customer_id},2025-01,electric,100\n")
+
+    assert b"Nothing was imported" in response.data
+    with app.app_context():
+        assert UsageRecord.query.count() == 1
+        assert db.session.get(UsageStats, (customer_id, "electric")).n == 1
+
+
+def test_bulk_bills_round_like_calculate_bill(client):
+    usage = [9, 0.125, 1000.5, 1234.5]
+    customer_ids = [add_customer(client, f"Customer {i}") for i in range(len(usage))]
+    for customer_id, value in zip(customer_ids, usage):
+        add_usage(client, customer_id, [value], utility_type="water")
+
+    # One bill already exists through the per-customer route and must not be duplicated
+    client.post(f"/customers/{customer_ids[0]}/generate_bill", data={"month": "2025-01", "utility_type": "water"})
+
+    with app.app_context():
+        assert billing.generate_bills_for_month("2025-01") == len(usage) - 1
+        assert billing.generate_bills_for_month("2025-01") == 0
+
+        bills = Bill.query.all()
+        assert len(bills) == len(usage)
+        for bill in bills:
+            assert bill.total_amount == billing.calculate_bill(bill.usage_value, bill.rate_per_unit, bill.base_fee)
+        assert db.session.get(Bill, bills[0].id).total_amount == 10.04  # 9 gallons of water